@@ -1,13 +1,27 @@
 import streamlit as st
-import fitz  # PyMuPDF
 import os
 import pandas as pd
 import re
-import string
+import shutil
+import tempfile
+import threading
+import asyncio
+import functools
+import hashlib
+import json
+import multiprocessing
 import time
+import uuid
+import diskcache
+import faiss
+import numpy as np
+import tiktoken
+import xlsxwriter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import BytesIO
-from tqdm import tqdm
-from openai import AzureOpenAI
+from openai import AsyncAzureOpenAI, AzureOpenAI, DefaultAsyncHttpxClient, NotFoundError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from extraction import EXTRACTION_VERSION, extract_worker
 
 # === SETUP ===
 st.set_page_config(page_title="Agri-Policy Classifier", layout="wide")
@@ -18,6 +32,16 @@ client = AzureOpenAI(
     azure_endpoint=st.secrets["AZURE_ENDPOINT"]
 )
 deployment = "gpt-4o"
+embedding_deployment = "text-embedding-3-small"
+MAX_CONCURRENT_REQUESTS = 32
+MAX_REQUESTS_PER_MINUTE = 300  # the deployment's RPM quota
+MAX_TOKENS_PER_MINUTE = 150_000  # the deployment's TPM quota
+PARAGRAPHS_PER_REQUEST = 5
+REQUEST_TOKEN_BUDGET = 4000  # paragraph tokens packed into one prompt
+EMBEDDING_BATCH_SIZE = 256  # inputs per embeddings request
+EMBEDDING_TOKEN_BUDGET = 100_000  # estimated input tokens per embeddings request, well under the API's cap
+BATCH_POLL_INTERVAL = 30  # seconds before a pending batch job is re-polled; doubles up to the max
+BATCH_POLL_MAX_INTERVAL = 600
 
 theme_codebook = {
     "Farmer Welfare": ["Farmer Incomes", "Nutrition Security", "Health & Life Insurance", "Livelihood Security", "Costs of Cultivation"],
@@ -30,148 +54,557 @@ theme_codebook = {
 main_themes = list(theme_codebook.keys())
 
 # === UTILITIES ===
-def clean_text(text):
-    return ''.join(c for c in text if c in string.printable)
-
-def is_probable_table(text):
-    lines = text.split('\n')
-    if "Table" in text or "Figure" in text:
-        return True
-    numeric_lines = sum(1 for line in lines if len(re.findall(r'\d+', line)) > 3)
-    num_ratio = sum(c.isdigit() for c in text) / max(1, len(text))
-    return numeric_lines >= 2 or num_ratio > 0.4
-
-def extract_paragraphs_from_pdf(file):
-    START_MARKERS = [r"^\s*(1|I|i)\.?\s*(Introduction|Executive Summary|Context|Overview|Background|Preamble)\b",
-                     r"^\s*(Chapter|Section)\s+(1|I|i)\b", r"^\s*Main\s+Report\b", r"^\s*Agricultural\s+Subsidies\b"]
-    END_MARKERS = [r"\breferences\b", r"\bbibliography\b", r"\bappendix\b"]
-
-    def page_has_marker(text, patterns):
-        return any(re.search(p, text, re.IGNORECASE | re.MULTILINE) for p in patterns)
-
-    def is_section_heading(text):
-        return bool(re.match(r'^\s*\d+[\.\)]?\s+[A-Z].{3,}', text.strip()))
-
-    doc = fitz.open(stream=file.read(), filetype="pdf")
-    paragraphs, found_start = [], False
-
-    for page_num, page in enumerate(doc, start=1):
-        text = page.get_text("text")
-        if not found_start:
-            lines = text.splitlines()
-            if page_has_marker(text, START_MARKERS) or any(is_section_heading(ln) for ln in lines):
-                found_start = True
-            else:
+def upload_key(file):
+    # getbuffer() is a zero-copy view, so hashing does not duplicate the PDF in memory
+    return file.name, hashlib.sha256(file.getbuffer()).hexdigest()
+
+@st.cache_resource
+def get_extraction_cache():
+    return diskcache.Cache("outputs/.extract_cache")
+
+def extract_uploads(files, on_done):
+    # Re-runs on the same files are served from the cache; only misses go to the pool.
+    # Uploads are streamed to disk so workers receive a path rather than a pickled copy of each PDF.
+    cache = get_extraction_cache()
+    keys = [(EXTRACTION_VERSION, *upload_key(f)) for f in files]
+    extracted = [cache.get(k) for k in keys]
+
+    def finish(n, paragraphs):
+        extracted[n] = cache[keys[n]] = paragraphs
+        on_done(files[n].name, len(paragraphs))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        payloads = []
+        for n, file in enumerate(files):
+            if extracted[n] is not None:
+                on_done(file.name, len(extracted[n]))
                 continue
-        if page_has_marker(text, END_MARKERS):
-            break
-        text = re.sub(r'(?<!\n)\n(?!\n)', ' ', text)
-        chunks = re.split(r'\n{2,}', text)
-        for chunk in chunks:
-            para = clean_text(chunk.strip())
-            if para and not is_probable_table(para):
-                if re.match(r'^\d+[\.\)]?\s+[A-Z]', para) or re.match(r'^Figure\s+\d+', para) or re.match(r'^Table\s+\d+', para) or (40 <= len(para.split()) <= 1000):
-                    paragraphs.append({"Document Name": file.name, "Page Number": page_num, "Paragraph": para})
-    return paragraphs
-
-def format_prompt(paragraph):
+            path = os.path.join(tmpdir, f"{n}.pdf")
+            file.seek(0)
+            with open(path, "wb") as out:
+                shutil.copyfileobj(file, out)
+            payloads.append((n, (file.name, path)))
+
+        if len(payloads) == 1:
+            n, payload = payloads[0]
+            finish(n, extract_worker(payload))
+        elif payloads:
+            # Forking the threaded Streamlit server can deadlock children; extraction.py imports no Streamlit, so spawn is cheap
+            with ProcessPoolExecutor(max_workers=min(len(payloads), os.cpu_count() or 1),
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = {executor.submit(extract_worker, payload): n for n, payload in payloads}
+                for future in as_completed(futures):
+                    finish(futures[future], future.result())
+    return extracted
+
+def prompt_instructions(task="read the paragraph"):
+    sub_theme_lines = "\n".join(f"{theme}: {', '.join(subs)}" for theme, subs in theme_codebook.items())
     return f"""You are an expert in agricultural sustainability and rural policy research.
 
-Your task is to read the paragraph and do the following:
-
----
+Your task is to {task} and:
+1. Select exactly one main theme.
+2. Choose one or more sub-themes strictly from those listed under the selected main theme:
+{sub_theme_lines}
+3. Write a brief but insightful research summary. Begin directly with the key insight; do NOT start with "This paragraph" or "It discusses".
 
-1️⃣ Select exactly **one main theme** from this list:
-{', '.join(main_themes)}
-
-2️⃣ Then, choose one or more **sub-themes strictly from the sub-theme list corresponding to the selected main theme**.
-
----
+"""
 
-📚 Sub-theme list by main theme:
+# Everything but the paragraph text is constant, so build the prompt around it once at import
+_PROMPT_PREFIX = prompt_instructions() + """Return the selected main theme, its sub-themes and the research-usable summary.
 
-Farmer Welfare → Farmer Incomes, Nutrition Security, Health & Life Insurance, Livelihood Security, Costs of Cultivation  
-Production Support → Water Management, Soil Health Management, Fertilisers, Pest Management, Access to Credit  
-Price Support → Price Discovery, Price Stability, Fair and Assured Price, Marketing, Collectivisation  
-Risk Management → Crop Insurance, Contract Farming  
-Environmental Sustainability → Climate Change, Sustainable Agriculture, Crop Diversification, Central Government Schemes, State Government Schemes  
-Financing → Union Budget Allocation, State Budget Allocation, Private Financing, Climate Financing
+Paragraph:
+\"\"\""""
+_PROMPT_SUFFIX = '"""\n'
+_BATCH_PROMPT_PREFIX = prompt_instructions("read EACH numbered paragraph independently") + """Return exactly one result per paragraph, using the paragraph number as its id.
 
----
+"""
 
-3️⃣ Write a brief but **insightful research summary**.
-- Do NOT start with “This paragraph” or “It discusses”.
-- Begin directly with the key insight.
+# Structured outputs guarantee a payload matching these schemas, so parsing is a single json.loads.
+# One theme variant per main theme ties its sub-themes to it; strict mode needs an object root,
+# so the anyOf sits under "theme".
+_THEME_VARIANTS = [{
+    "type": "object",
+    "properties": {
+        "main_theme": {"type": "string", "enum": [theme]},
+        "sub_themes": {"type": "array", "items": {"type": "string", "enum": subs}}
+    },
+    "required": ["main_theme", "sub_themes"],
+    "additionalProperties": False
+} for theme, subs in theme_codebook.items()]
+_CLASSIFICATION_PROPERTIES = {
+    "theme": {"anyOf": _THEME_VARIANTS},
+    "summary": {"type": "string"}
+}
+_CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": _CLASSIFICATION_PROPERTIES,
+    "required": list(_CLASSIFICATION_PROPERTIES),
+    "additionalProperties": False
+}
+_BATCH_CLASSIFICATION_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": {
+        "type": "object",
+        "properties": {"id": {"type": "integer"}, **_CLASSIFICATION_PROPERTIES},
+        "required": ["id", *_CLASSIFICATION_PROPERTIES],
+        "additionalProperties": False
+    }}},
+    "required": ["results"],
+    "additionalProperties": False
+}
+RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "classification", "schema": _CLASSIFICATION_SCHEMA, "strict": True}}
+BATCH_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": {"name": "classifications", "schema": _BATCH_CLASSIFICATION_SCHEMA, "strict": True}}
 
----
+def format_prompt(paragraph):
+    return _PROMPT_PREFIX + paragraph + _PROMPT_SUFFIX
 
-📥 Return in this format:
+def format_prompt_batch(paragraphs):
+    return _BATCH_PROMPT_PREFIX + "\n\n".join(f'Paragraph {n}:\n"""{p}"""' for n, p in enumerate(paragraphs, start=1)) + "\n"
 
-Main Theme: <selected main theme>  
-Sub-Themes: [comma-separated list]  
-Summary: <research-usable summary>
-
-Paragraph:
-\"\"\"{paragraph}\"\"\"
-"""
+_UNSAFE_RE = re.compile(r"[^\w\s-]")
 
 def safe_theme_name(theme):
-    return re.sub(r"[^\w\s-]", "", str(theme)).strip().replace(" ", "_")
-
-def classify_paragraphs(df):
-    df["Main Theme"] = ""
-    df["Sub-Theme(s)"] = ""
-    df["Research Summary"] = ""
-    for i in tqdm(df.index):
-        prompt = format_prompt(df.at[i, "Paragraph"])
+    return _UNSAFE_RE.sub("", str(theme)).strip().replace(" ", "_")
+
+# Model output is constrained to main_themes, so the sanitised names are a dict lookup
+_SAFE_NAMES = {t: safe_theme_name(t) for t in main_themes}
+
+def _to_row(obj):
+    theme = obj["theme"]
+    return _SAFE_NAMES.get(theme["main_theme"]) or safe_theme_name(theme["main_theme"]), ", ".join(s.strip() for s in theme["sub_themes"]), obj["summary"].strip()
+
+def parse_response(res):
+    try:
+        return _to_row(json.loads(res))
+    except Exception as e:
+        return "PARSE_ERROR", f"PARSE ERROR: {e}", res
+
+def parse_batch_response(res, n):
+    try:
+        results = [("PARSE_ERROR", "PARSE ERROR: missing from response", res)] * n
+        for item in json.loads(res)["results"]:
+            if 1 <= item["id"] <= n:
+                results[item["id"] - 1] = _to_row(item)
+        return results
+    except Exception as e:
+        return [("PARSE_ERROR", f"PARSE ERROR: {e}", res)] * n
+
+def assign_results(df, results):
+    # Build whole columns once instead of writing cells row by row
+    mains, subs, summaries = (list(col) for col in zip(*results))
+    df["Main Theme"] = mains
+    df["Sub-Theme(s)"] = subs
+    df["Research Summary"] = summaries
+    return df
+
+# Loaded on first use: tiktoken downloads the encoding file, which Batch mode never needs
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    return tiktoken.encoding_for_model(deployment)
+
+def group_paragraphs(positions, paragraphs, per_request):
+    # Pack up to per_request paragraphs per prompt, within a token budget
+    groups, group, group_tokens = [], [], 0
+    for pos in positions:
+        tokens = len(get_encoding().encode_ordinary(paragraphs[pos]))
+        if group and (len(group) == per_request or group_tokens + tokens > REQUEST_TOKEN_BUDGET):
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(pos)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+def make_async_client():
+    # HTTP/2 lets all in-flight requests share one multiplexed connection.
+    # SDK retries would bypass the rate limiters, so tenacity in _complete_async is the only retry path.
+    return AsyncAzureOpenAI(
+        api_key=st.secrets["AZURE_API_KEY"],
+        api_version="2025-01-01-preview",
+        azure_endpoint=st.secrets["AZURE_ENDPOINT"],
+        http_client=DefaultAsyncHttpxClient(http2=True),
+        max_retries=0
+    )
+
+# === RATE LIMITS ===
+# Leaky bucket (same model as aiolimiter) shared by every session in the process, so concurrent runs
+# split the deployment's quota instead of each getting all of it. aiolimiter's limiter can't be shared:
+# each session runs its own event loop in its own thread.
+class RateLimiter:
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate, self.rate = max_rate, max_rate / time_period
+        self.level, self.updated = 0.0, time.monotonic()
+        self.lock = threading.Lock()
+
+    async def acquire(self, amount=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.level = max(0.0, self.level - (now - self.updated) * self.rate)
+                self.updated = now
+                if self.level + amount <= self.max_rate:
+                    self.level += amount
+                    return
+                wait = (self.level + amount - self.max_rate) / self.rate
+            await asyncio.sleep(wait)
+
+@st.cache_resource
+def get_rate_limiters():
+    return RateLimiter(MAX_REQUESTS_PER_MINUTE), RateLimiter(MAX_TOKENS_PER_MINUTE)
+
+# === RESPONSE CACHE ===
+# Exact-match tier keyed on the prompt hash, with an embedding-similarity fallback
+class LLMCache:
+    def __init__(self, path, threshold=0.95):
+        self.store = diskcache.Cache(path)
+        self.threshold = threshold
+        self.index, self.values = None, []
+        # Shared across sessions; vector ids in the index must stay aligned with self.values
+        self.lock = threading.Lock()
+        for key in self.store:
+            if key.startswith("emb:"):
+                self._add_vector(*self.store[key])
+
+    def _add_vector(self, vector, value):
+        with self.lock:
+            if self.index is None:
+                self.index = faiss.IndexFlatIP(vector.shape[1])
+            self.index.add(vector)
+            self.values.append(value)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def get_similar(self, vector):
+        with self.lock:
+            if self.index is None:
+                return None
+            scores, ids = self.index.search(vector, 1)
+            return self.values[ids[0][0]] if scores[0][0] >= self.threshold else None
+
+    def put(self, key, vector, value):
+        self.store[key] = value
+        if vector is not None:
+            self.store[f"emb:{key}"] = (vector, value)
+            self._add_vector(vector, value)
+
+# Cached results are only valid for the prompts, schemas and models that produced them; any change
+# opens a fresh store, so neither tier can serve labels from an older prompt
+CACHE_VERSION = hashlib.sha256(json.dumps([
+    deployment, embedding_deployment, _PROMPT_PREFIX, _BATCH_PROMPT_PREFIX, RESPONSE_FORMAT, BATCH_RESPONSE_FORMAT
+]).encode("utf-8")).hexdigest()[:16]
+
+@st.cache_resource
+def get_llm_cache():
+    return LLMCache(f"outputs/.llm_cache/{CACHE_VERSION}")
+
+def cache_key(paragraph):
+    return hashlib.sha256(f"{deployment}||{format_prompt(paragraph)}".encode("utf-8")).hexdigest()
+
+@retry(retry=retry_if_exception_type(RateLimitError), wait=wait_exponential_jitter(initial=1, max=30),
+       stop=stop_after_attempt(5), reraise=True)
+async def _embed_chunk_async(aclient, chunk):
+    res = await aclient.embeddings.create(model=embedding_deployment, input=chunk)
+    vectors = np.asarray([d.embedding for d in res.data], dtype="float32")
+    faiss.normalize_L2(vectors)
+    return [v.reshape(1, -1) for v in vectors]
+
+async def _embed_async(aclient, paragraphs):
+    # Chunks are capped by count and by estimated tokens (~4 characters each): a full chunk of long
+    # paragraphs would otherwise exceed the per-request input limit
+    chunks, chunk, chunk_tokens = [], [], 0
+    for p in paragraphs:
+        tokens = len(p) // 4 + 1
+        if chunk and (len(chunk) == EMBEDDING_BATCH_SIZE or chunk_tokens + tokens > EMBEDDING_TOKEN_BUDGET):
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(p)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    vectors, errors = [], []
+    for chunk in chunks:
         try:
-            res = client.chat.completions.create(
-                model=deployment,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0
-            ).choices[0].message.content
+            vectors.extend(await _embed_chunk_async(aclient, chunk))
         except Exception as e:
-            res = f"ERROR: {e}"
+            # A failed chunk only drops its own paragraphs from the similarity lookup
+            errors.append(e)
+            vectors.extend([None] * len(chunk))
+    return vectors, errors
+
+# Rate-limit (429) responses back off and retry instead of failing the row
+@retry(retry=retry_if_exception_type(RateLimitError), wait=wait_exponential_jitter(initial=1, max=30),
+       stop=stop_after_attempt(5), reraise=True)
+async def _complete_async(aclient, limiters, prompt):
+    # Every attempt, retries included, draws from both buckets so we stay under the quotas proactively;
+    # ~4 characters per token is close enough for throttling
+    rpm_limiter, tpm_limiter = limiters
+    await tpm_limiter.acquire(min(len(prompt) // 4, MAX_TOKENS_PER_MINUTE))
+    await rpm_limiter.acquire()
+    res = await aclient.chat.completions.create(
+        model=deployment,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0,
+        response_format=BATCH_RESPONSE_FORMAT
+    )
+    return res.choices[0].message.content
+
+async def _classify_group_async(aclient, sem, limiters, group, paragraphs):
+    async with sem:
         try:
-            df.at[i, "Main Theme"] = safe_theme_name(res.split("Main Theme:")[1].split("Sub-Themes:")[0].strip())
-            subs = res.split("Sub-Themes:")[1].split("Summary:")[0].strip()
-            df.at[i, "Sub-Theme(s)"] = ", ".join([s.strip() for s in subs.strip("[]").split(",")])
-            df.at[i, "Research Summary"] = res.split("Summary:")[1].strip()
+            res = await _complete_async(aclient, limiters, format_prompt_batch([paragraphs[pos] for pos in group]))
         except Exception as e:
-            df.at[i, "Main Theme"] = "PARSE_ERROR"
-            df.at[i, "Sub-Theme(s)"] = f"PARSE ERROR: {e}"
-            df.at[i, "Research Summary"] = res
-        time.sleep(1.5)
-    return df
+            res = f"ERROR: {e}"
+    return group, parse_batch_response(res, len(group))
+
+async def classify_paragraphs_async(df, per_request=PARAGRAPHS_PER_REQUEST, semantic=False):
+    cache = get_llm_cache()
+    paragraphs = df["Paragraph"].tolist()
+    keys = [cache_key(p) for p in paragraphs]
+    results = [cache.get(k) for k in keys]
+    vectors = [None] * len(paragraphs)
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    limiters = get_rate_limiters()
+    async with make_async_client() as aclient:
+        missing = [pos for pos, r in enumerate(results) if r is None]
+        # A similarity hit reuses the whole cached row, summary included, so it is opt-in
+        if semantic and missing:
+            embedded, errors = await _embed_async(aclient, [paragraphs[pos] for pos in missing])
+            for pos, vector in zip(missing, embedded):
+                if vector is not None:
+                    vectors[pos] = vector
+                    results[pos] = cache.get_similar(vector)
+            if errors:
+                st.warning(f"⚠️ {len(errors)} embedding request(s) failed; their paragraphs skip the similarity cache: {errors[0]}")
+        todo = [pos for pos, r in enumerate(results) if r is None]
+        done = len(paragraphs) - len(todo)
+        progress = st.progress(done / len(paragraphs), text="🤖 Classifying paragraphs...")
+        tasks = [_classify_group_async(aclient, sem, limiters, group, paragraphs) for group in group_paragraphs(todo, paragraphs, per_request)]
+        for next_done in asyncio.as_completed(tasks):
+            group, group_results = await next_done
+            for pos, r in zip(group, group_results):
+                if r[0] != "PARSE_ERROR":
+                    cache.put(keys[pos], vectors[pos], r)
+                results[pos] = r
+            done += len(group)
+            progress.progress(done / len(paragraphs), text=f"🤖 Classified {done}/{len(paragraphs)} paragraphs")
+        progress.empty()
+    # Hit/miss counts for this run only; the cache object itself is shared across sessions
+    return assign_results(df, results), len(paragraphs) - len(todo), len(todo)
+
+def with_results(df, classified):
+    # classified has one row per distinct paragraph; fan its labels out to every occurrence
+    return df.merge(classified, on="Paragraph", how="left")
+
+def build_batch_jsonl(df):
+    lines = [json.dumps({
+        "custom_id": str(i),
+        "method": "POST",
+        "url": "/chat/completions",
+        "body": {
+            "model": deployment,
+            "messages": [{"role": "user", "content": format_prompt(p)}],
+            "temperature": 0,
+            "response_format": RESPONSE_FORMAT
+        }
+    }) for i, p in zip(df.index, df["Paragraph"])]
+    return "\n".join(lines).encode("utf-8")
+
+@st.cache_resource
+def get_batch_store():
+    # Pending jobs live on disk, so closing the tab during the 24h window doesn't orphan a paid job.
+    # Payloads are keyed on the job id, the submitting session on "owner:<job id>".
+    return diskcache.Cache("outputs/.batch_jobs")
+
+def save_batch_job(job_id, owner, df, unique_df):
+    store = get_batch_store()
+    store[job_id] = {"df": df, "unique_df": unique_df}
+    store[f"owner:{job_id}"] = owner
+
+def pending_batch_jobs():
+    store = get_batch_store()
+    return {key: store.get(f"owner:{key}") for key in store if not key.startswith("owner:")}
+
+def drop_batch_job(job_id):
+    store = get_batch_store()
+    store.delete(job_id)
+    store.delete(f"owner:{job_id}")
+
+def submit_batch(df):
+    batch_file = client.files.create(file=("batch.jsonl", build_batch_jsonl(df)), purpose="batch")
+    job = client.batches.create(input_file_id=batch_file.id, endpoint="/chat/completions", completion_window="24h")
+    return job.id
+
+def _iter_batch_file(file_id):
+    # Stream the JSONL result file line by line instead of loading it into one string
+    with client.files.with_streaming_response.content(file_id) as response:
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+def batch_responses(job):
+    responses = {}
+    # Failed requests are written to the error file, not the output file
+    for file_id in (job.output_file_id, job.error_file_id):
+        if not file_id:
+            continue
+        for item in _iter_batch_file(file_id):
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                responses[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            else:
+                responses[item["custom_id"]] = f"ERROR: {item.get('error') or response.get('body')}"
+    return responses
+
+def collect_batch(df, responses=None):
+    # Cached paragraphs were never submitted; everything else comes from the batch output
+    cache = get_llm_cache()
+    responses = responses or {}
+    results = []
+    for i, p in zip(df.index, df["Paragraph"]):
+        key = cache_key(p)
+        r = cache.get(key)
+        if r is None:
+            r = parse_response(responses.get(str(i), "ERROR: missing from batch output"))
+            if r[0] != "PARSE_ERROR":
+                cache.put(key, None, r)
+        results.append(r)
+    return assign_results(df, results)
+
+# Keyed on the frame's content hash, so re-running on an unchanged corpus reuses the workbooks
+@st.cache_data(show_spinner=False, max_entries=32)
+def to_xlsx_bytes(df):
+    # constant_memory flushes each row as it is written, so rows must be written in order;
+    # pandas' to_excel writes column by column, hence the direct row-wise write here.
+    buffer = BytesIO()
+    workbook = xlsxwriter.Workbook(buffer, {
+        "constant_memory": True,
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+        "nan_inf_to_errors": True
+    })
+    sheet = workbook.add_worksheet()
+    sheet.write_row(0, 0, df.columns.tolist(), workbook.add_format({"bold": True}))
+    for row_num, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        sheet.write_row(row_num, 0, row)
+    workbook.close()
+    return buffer.getvalue()
+
+def to_parquet_bytes(df):
+    buffer = BytesIO()
+    df.to_parquet(buffer, index=False, engine="pyarrow", compression="zstd")
+    return buffer.getvalue()
+
+def store_results(combined_df):
+    # Main themes come from a small closed set, so a categorical makes the theme-wise groupby cheap
+    combined_df["Main Theme"] = combined_df["Main Theme"].astype("category")
+    # Serialize once; the same bytes go to disk and to the download button
+    data = to_xlsx_bytes(combined_df)
+    with open("outputs/Combined_Results.xlsx", "wb") as out:
+        out.write(data)
+    st.session_state["combined_df"] = combined_df
+    st.session_state["combined_xlsx"] = data
+    # Columnar/plain-text exports are far cheaper than xlsx on large corpora
+    st.session_state["combined_csv"] = combined_df.to_csv(index=False).encode("utf-8")
+    st.session_state["combined_parquet"] = to_parquet_bytes(combined_df)
+    # Theme workbooks are built once here, not on every rerun triggered by a download click
+    st.session_state["theme_xlsx"] = {
+        safe_theme_name(theme): to_xlsx_bytes(themed_df)
+        for theme, themed_df in combined_df.groupby("Main Theme", sort=False, observed=True)
+    }
+    st.success("✅ Combined Results saved to: outputs/Combined_Results.xlsx")
 
 # === SIDEBAR UI ===
 st.sidebar.title("📂 Upload Files")
 uploaded_files = st.sidebar.file_uploader("Upload PDF files", type="pdf", accept_multiple_files=True)
+mode = st.sidebar.radio("Mode", ["⏱ Fast (real-time)", "💸 Batch (cheaper, async)"])
+batch_mode = mode.startswith("💸")
+# Larger groups save prompt tokens and requests, but latency and label quality degrade with input size
+per_request = st.sidebar.slider("Paragraphs per request", 1, 10, PARAGRAPHS_PER_REQUEST, disabled=batch_mode)
+semantic = st.sidebar.checkbox(
+    "Reuse results for near-duplicate paragraphs", disabled=batch_mode,
+    help="Paragraphs ≥95% similar to a cached one reuse its themes and summary, even if names or figures differ."
+)
 run = st.sidebar.button("🚀 Run Classification")
 
 # === MAIN INTERFACE ===
 st.title("📄 Agri-Policy Classifier")
+# Identifies this browser session as the owner of the batch jobs it submits
+session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
 
 if run and uploaded_files:
     os.makedirs("outputs/themes", exist_ok=True)
     all_results = []
 
-    for file in uploaded_files:
-        st.write(f"🔍 Extracting from: `{file.name}`")
-        paragraphs = extract_paragraphs_from_pdf(file)
-        df = pd.DataFrame(paragraphs)
+    with st.status("🔍 Extracting paragraphs...") as status:
+        extracted = extract_uploads(uploaded_files, lambda name, n: status.write(f"🔍 Extracted {n} paragraphs from: `{name}`"))
+        status.update(label=f"🔍 Extracted {len(uploaded_files)} file(s)", state="complete")
 
-        if not df.empty:
-            df = classify_paragraphs(df)
-            all_results.append(df)
+    for file, paragraphs in zip(uploaded_files, extracted):
+        if paragraphs:
+            all_results.append(pd.DataFrame(paragraphs))
         else:
             st.warning(f"⚠️ No valid paragraphs found in: {file.name}")
 
     if all_results:
         combined_df = pd.concat(all_results, ignore_index=True)
-        st.session_state["combined_df"] = combined_df
-        combined_df.to_excel("outputs/Combined_Results.xlsx", index=False)
-        st.success("✅ Combined Results saved to: outputs/Combined_Results.xlsx")
+        # Boilerplate repeats within and across documents; classify each distinct paragraph once
+        unique_df = combined_df[["Paragraph"]].drop_duplicates().reset_index(drop=True)
+        if batch_mode:
+            cache = get_llm_cache()
+            pending = unique_df[[cache.get(cache_key(p)) is None for p in unique_df["Paragraph"]]]
+            if pending.empty:
+                store_results(with_results(combined_df, collect_batch(unique_df)))
+            else:
+                job_id = submit_batch(pending)
+                save_batch_job(job_id, session_id, combined_df, unique_df)
+                st.info(f"💸 Submitted batch job `{job_id}` for {len(pending)} of {len(combined_df)} paragraphs "
+                        f"(the rest are cached or duplicates). Results usually arrive within 24h.")
+        else:
+            unique_df, hits, misses = asyncio.run(classify_paragraphs_async(unique_df, per_request, semantic))
+            store_results(with_results(combined_df, unique_df))
+            st.sidebar.caption(f"🧠 Cache hits: {hits} / misses: {misses}")
+
+# === BATCH STATUS ===
+jobs = pending_batch_jobs()
+# Jobs whose session has gone (e.g. the tab was closed) can be claimed and collected from any session
+unclaimed = [job_id for job_id, owner in jobs.items() if owner != session_id]
+if unclaimed:
+    resume_id = st.sidebar.selectbox("Other pending batch jobs", unclaimed)
+    if st.sidebar.button("📥 Collect this job"):
+        get_batch_store()[f"owner:{resume_id}"] = session_id
+        jobs[resume_id] = session_id
+own_jobs = [job_id for job_id, owner in jobs.items() if owner == session_id]
+# Polls back off while a job is pending, so download clicks and other reruns don't each hit the API
+force_poll = bool(own_jobs) and st.sidebar.button("🔄 Check Batch Status")
+polls = st.session_state.setdefault("batch_polls", {})
+for job_id in own_jobs:
+    poll = polls.setdefault(job_id, {"due": 0, "interval": BATCH_POLL_INTERVAL, "status": "submitted"})
+    if force_poll or time.time() >= poll["due"]:
+        try:
+            job = client.batches.retrieve(job_id)
+            if job.status == "completed":
+                os.makedirs("outputs/themes", exist_ok=True)
+                batch_job = get_batch_store()[job_id]
+                store_results(with_results(batch_job["df"], collect_batch(batch_job["unique_df"], batch_responses(job))))
+            elif job.status in ("failed", "expired", "cancelled"):
+                st.error(f"❌ Batch job `{job_id}` {job.status}")
+            poll["status"] = job.status
+        except NotFoundError:
+            st.error(f"❌ Batch job `{job_id}` no longer exists")
+            poll["status"] = "missing"
+        except Exception as e:
+            # Transient API or collection errors keep the job; it is retried on a later poll
+            st.error(f"⚠️ Could not check batch job `{job_id}`: {e}")
+            poll["status"] = "check failed"
+        if poll["status"] in ("completed", "failed", "expired", "cancelled", "missing"):
+            drop_batch_job(job_id)
+            del polls[job_id]
+            continue
+        poll["due"] = time.time() + poll["interval"]
+        poll["interval"] = min(poll["interval"] * 2, BATCH_POLL_MAX_INTERVAL)
+    st.sidebar.info(f"💸 Batch `{job_id}`: {poll['status']}")
 
 # === DISPLAY & DOWNLOAD ===
 if "combined_df" in st.session_state:
@@ -180,16 +613,13 @@ if "combined_df" in st.session_state:
     # st.subheader("📊 View Results")
     # st.dataframe(df, use_container_width=True)
 
-    excel_io = BytesIO()
-    df.to_excel(excel_io, index=False)
-    st.download_button("📥 Download Combined Excel", data=excel_io.getvalue(), file_name="Combined_Results.xlsx")
+    xlsx_col, csv_col, parquet_col = st.columns(3)
+    xlsx_col.download_button("📥 Download Combined Excel", data=st.session_state["combined_xlsx"], file_name="Combined_Results.xlsx")
+    csv_col.download_button("⚡ Download CSV", data=st.session_state["combined_csv"], file_name="Combined_Results.csv", mime="text/csv")
+    parquet_col.download_button("⚡ Download Parquet", data=st.session_state["combined_parquet"], file_name="Combined_Results.parquet")
 
-    for theme in df["Main Theme"].dropna().unique():
-        themed_df = df[df["Main Theme"] == theme]
-        if not themed_df.empty:
-            buffer = BytesIO()
-            themed_df.to_excel(buffer, index=False)
-            st.download_button(f"📂 Download: {safe_theme_name(theme)}", data=buffer.getvalue(), file_name=f"{safe_theme_name(theme)}.xlsx")
+    for name, data in st.session_state["theme_xlsx"].items():
+        st.download_button(f"📂 Download: {name}", data=data, file_name=f"{name}.xlsx")
 #
 # if "combined_df" in st.session_state:
 #     df = st.session_state["combined_df"]
@@ -0,0 +1,82 @@
+import fitz  # PyMuPDF
+import re
+import string
+
+# Bump when extraction output changes, so persisted extraction caches are invalidated
+EXTRACTION_VERSION = 4
+
+# === UTILITIES ===
+# string.printable is pure ASCII, so drop non-ASCII in C and then the few ASCII control chars
+_NON_PRINTABLE_ASCII = dict.fromkeys(i for i in range(128) if chr(i) not in string.printable)
+
+def clean_text(text):
+    # isascii() reads a flag on the str object, so pure-ASCII pages skip the encode/decode copy
+    if not text.isascii():
+        text = text.encode('ascii', 'ignore').decode('ascii')
+    return text.translate(_NON_PRINTABLE_ASCII)
+
+_DELETE_DIGITS = dict.fromkeys(map(ord, "0123456789"))
+
+def is_probable_table(text):
+    if "Table" in text or "Figure" in text:
+        return True
+    # Digit count from one C-level translate pass (text is ASCII after clean_text)
+    num_ratio = (len(text) - len(text.translate(_DELETE_DIGITS))) / max(1, len(text))
+    return num_ratio > 0.4
+
+START_MARKERS = [r"^\s*(1|I|i)\.?\s*(Introduction|Executive Summary|Context|Overview|Background|Preamble)\b",
+                 r"^\s*(Chapter|Section)\s+(1|I|i)\b", r"^\s*Main\s+Report\b", r"^\s*Agricultural\s+Subsidies\b"]
+END_MARKERS = [r"\breferences\b", r"\bbibliography\b", r"\bappendix\b"]
+# One alternation per marker list: a single scan of the page instead of one per pattern
+_START_RE = re.compile('|'.join(f'(?:{p})' for p in START_MARKERS), re.IGNORECASE | re.MULTILINE)
+_END_RE = re.compile('|'.join(f'(?:{p})' for p in END_MARKERS), re.IGNORECASE | re.MULTILINE)
+_SECTION_HDR_RE = re.compile(r'^\s*\d+[\.\)]?\s+[A-Z].{3,}')
+HEADER_FOOTER_MARGIN = 0.06  # fraction of page height
+# Numbered headings, figure and table captions are kept regardless of length
+_IMPORTANT_RE = re.compile(r'^(?:\d+[\.\)]?\s+[A-Z]|Figure\s+\d+|Table\s+\d+)')
+
+# === PDF EXTRACTION ===
+def extract_paragraphs_from_doc(doc, name):
+    def is_section_heading(text):
+        return bool(_SECTION_HDR_RE.match(text.strip()))
+
+    paragraphs, found_start = [], False
+
+    for page_num, page in enumerate(doc, start=1):
+        if not found_start:
+            text = page.get_text("text")
+            lines = text.splitlines()
+            if _START_RE.search(text) or any(is_section_heading(ln) for ln in lines):
+                found_start = True
+            else:
+                continue
+        # (x0, y0, x1, y1, text, block_no, block_type); block_type 1 is an image.
+        # Blocks inside the top/bottom margin bands are running headers, footers and page numbers.
+        top, bottom = page.rect.height * HEADER_FOOTER_MARGIN, page.rect.height * (1 - HEADER_FOOTER_MARGIN)
+        blocks = [b[4] for b in page.get_text("blocks") if b[6] == 0 and b[3] > top and b[1] < bottom]
+        # Keep the main-report text ahead of the END marker on its page, then stop after that page
+        reached_end = False
+        for i, block in enumerate(blocks):
+            m = _END_RE.search(block)
+            if m:
+                blocks, reached_end = blocks[:i] + [block[:m.start()]], True
+                break
+        for block in blocks:
+            para = clean_text(block.replace('\n', ' ').strip())
+            # Cheap shape checks first; most rejected blocks never reach the table scan
+            if not para or not (40 <= len(para.split()) <= 1000 or _IMPORTANT_RE.match(para)):
+                continue
+            if is_probable_table(para):
+                continue
+            paragraphs.append({"Document Name": name, "Page Number": page_num, "Paragraph": para})
+        if reached_end:
+            break
+    return paragraphs
+
+def extract_paragraphs_from_pdf(name, path):
+    with fitz.open(path) as doc:
+        return extract_paragraphs_from_doc(doc, name)
+
+def extract_worker(payload):
+    # Top-level and free of Streamlit/client state so ProcessPoolExecutor can pickle it
+    return extract_paragraphs_from_pdf(*payload)